@@ -6,18 +6,81 @@
 # SPDX-License-Identifier: MPL-2.0
 # This file is part of Grid2Op, Grid2Op a testbed platform to model sequential decision making in power systems.
 
-import copy
-from typing import Dict, Literal, Optional, Tuple, Type, Union
+from typing import Dict, List, Literal, Optional, Tuple, Type, Union
 
 import numpy as np
 from grid2op.Space import GridObjects
 import grid2op.Backend
 from grid2op.typing_variables import CLS_AS_DICT_TYPING
 from grid2op.Exceptions import Grid2OpException
+from grid2op.dtypes import dt_bool, dt_int
+
+try:
+    from numba import njit  # type: ignore
+    NUMBA_ = True
+except (ImportError, ModuleNotFoundError):
+    NUMBA_ = False
+
+
+if NUMBA_:
+    @njit(cache=True, boundscheck=False)
+    def _has_invalid_bus_kernel(topo_vect, n_busbar):
+        # same as the check in `_EnvPreviousState.fix_topo_bus`
+        # but stops at the first invalid bus
+        for i in range(topo_vect.shape[0]):
+            bus = topo_vect[i]
+            if bus <= -2 or bus == 0 or bus > n_busbar:
+                return True
+        return False
+        
+    @njit(cache=True, boundscheck=False)
+    def _fix_topo_bus_kernel(topo_vect, n_busbar):
+        # same as the numpy code in `_EnvPreviousState.fix_topo_bus` 
+        # but in one single pass
+        for i in range(topo_vect.shape[0]):
+            bus = topo_vect[i]
+            if bus <= -2 or bus == 0:
+                topo_vect[i] = -1
+            elif bus > n_busbar:
+                topo_vect[i] = 1
+
+    @njit(cache=True, boundscheck=False)
+    def _update_kernel(topo_vect,
+                       load_pos_topo_vect, load_p, load_q, loads,
+                       gen_pos_topo_vect, gen_p, gen_v, gens,
+                       storage_pos_topo_vect, storage_p, storage_state,
+                       topo_vect_state, bus_max):
+        # same as the numpy code in `_EnvPreviousState.update` (for
+        # loads, generators, storage units and topo_vect) but without
+        # any temporary array
+        for i in range(load_pos_topo_vect.shape[0]):
+            if topo_vect[load_pos_topo_vect[i]] > 0:
+                loads[0, i] = load_p[i]
+                loads[1, i] = load_q[i]
+        for i in range(gen_pos_topo_vect.shape[0]):
+            if topo_vect[gen_pos_topo_vect[i]] > 0:
+                gens[0, i] = gen_p[i]
+                gens[1, i] = gen_v[i]
+        for i in range(storage_pos_topo_vect.shape[0]):
+            if topo_vect[storage_pos_topo_vect[i]] > 0:
+                storage_state[i] = storage_p[i]
+        for i in range(topo_vect.shape[0]):
+            if topo_vect[i] > 0:
+                topo_vect_state[i] = min(topo_vect[i], bus_max)
 
 
 class _EnvPreviousState(object):
     ERR_MSG_IMP_MODIF = "Impossible to modifiy this _EnvPreviousState"
+    # values compared in `where_different`
+    _COMPARED_ATTRS = ("_load_p",
+                       "_load_q",
+                       "_gen_p",
+                       "_gen_v",
+                       "_storage_p",
+                       "_topo_vect",
+                       "_shunt_p",
+                       "_shunt_q",
+                       "_shunt_bus")
     
     def __init__(self,
                  grid_obj_cls: Union[Type[GridObjects], CLS_AS_DICT_TYPING],
@@ -33,27 +96,157 @@ class _EnvPreviousState(object):
                  init_switch_state: Optional[np.ndarray]=None):
         self._can_modif = True
         if isinstance(grid_obj_cls, type):
-            self._grid_obj_cls : CLS_AS_DICT_TYPING = grid_obj_cls.cls_to_dict()
+            if grid_obj_cls._CLS_DICT_EXTENDED is None:
+                # computed once and for all and stored in the class
+                grid_obj_cls._make_cls_dict_extended(grid_obj_cls, {}, as_list=False)
+            # NB: this dict is shared with the class, it must not be modified
+            self._grid_obj_cls : CLS_AS_DICT_TYPING = grid_obj_cls._CLS_DICT_EXTENDED
         elif isinstance(grid_obj_cls, dict):
             self._grid_obj_cls : CLS_AS_DICT_TYPING = grid_obj_cls
         self._n_storage = len(self._grid_obj_cls["name_storage"])  # to avoid typing that over and over again
         
-        self._load_p : np.ndarray = init_load_p.copy()
-        self._load_q : np.ndarray = init_load_q.copy()
-        self._gen_p : np.ndarray = init_gen_p.copy()
-        self._gen_v : np.ndarray = init_gen_v.copy()
-        self._storage_p : np.ndarray = init_storage_p.copy()
-        self._topo_vect : np.ndarray = init_topo_vect.copy()
-        self._shunt_p : np.ndarray = init_shunt_p.copy()
-        self._shunt_q : np.ndarray = init_shunt_q.copy()
-        self._shunt_bus : np.ndarray = init_shunt_bus.copy()
+        # static data used at each call to `update`, retrieved once and for all
+        self._load_pos_topo_vect : np.ndarray = np.asarray(self._grid_obj_cls["load_pos_topo_vect"], dtype=np.intp)
+        self._gen_pos_topo_vect : np.ndarray = np.asarray(self._grid_obj_cls["gen_pos_topo_vect"], dtype=np.intp)
+        self._storage_pos_topo_vect : np.ndarray = np.asarray(self._grid_obj_cls["storage_pos_topo_vect"], dtype=np.intp)
+        self._n_busbar : int = int(self._grid_obj_cls["n_busbar_per_sub"])
+        self._load_bus_buffer : np.ndarray = np.empty(self._load_pos_topo_vect.size, dtype=dt_int)
+        self._gen_bus_buffer : np.ndarray = np.empty(self._gen_pos_topo_vect.size, dtype=dt_int)
+        self._storage_bus_buffer : np.ndarray = np.empty(self._storage_pos_topo_vect.size, dtype=dt_int)
+        self._load_mask : np.ndarray = np.empty(self._load_pos_topo_vect.size, dtype=dt_bool)
+        self._gen_mask : np.ndarray = np.empty(self._gen_pos_topo_vect.size, dtype=dt_bool)
+        self._storage_mask : np.ndarray = np.empty(self._storage_pos_topo_vect.size, dtype=dt_bool)
+        
+        # arrays actually stored: all float values are in `_float_state` and 
+        # all int values in `_int_state`, the other attributes are views on them
+        n_load = init_load_p.shape[0]
+        n_gen = init_gen_p.shape[0]
+        n_storage = init_storage_p.shape[0]
+        n_shunt = init_shunt_p.shape[0]
+        dim_topo = init_topo_vect.shape[0]
+        self._layout : Tuple[int, ...] = (n_load, n_gen, n_storage, n_shunt, dim_topo)
+        end_load = 2 * n_load
+        end_gen = end_load + 2 * n_gen
+        end_storage = end_gen + n_storage
+        self._loads_slice = slice(0, end_load)
+        self._gens_slice = slice(end_load, end_gen)
+        self._storage_slice = slice(end_gen, end_storage)
+        self._shunts_slice = slice(end_storage, end_storage + 2 * n_shunt)
+        self._topo_vect_slice = slice(0, dim_topo)
+        self._shunt_bus_slice = slice(dim_topo, dim_topo + n_shunt)
+        
+        init_float = (init_load_p, init_load_q,
+                      init_gen_p, init_gen_v,
+                      init_storage_p,
+                      init_shunt_p, init_shunt_q)
+        # NB: all values are stored with the same dtype, if the input arrays do not
+        # have the same dtype, the "largest" one is used (no value is truncated)
+        self._float_state : np.ndarray = np.empty(end_storage + 2 * n_shunt,
+                                                  dtype=np.result_type(*init_float))
+        np.concatenate(init_float, out=self._float_state)
+        # buses are small integers, int8 is enough for them (unless
+        # there are really a lot of busbars per substation)
+        if self._n_busbar < np.iinfo(np.int8).max:
+            int_dtype = np.dtype(np.int8)
+        else:
+            int_dtype = np.result_type(init_topo_vect, init_shunt_bus)
+        # buses that cannot be stored are saturated (and not wrapped around), 
+        # they are then still invalid buses for `fix_topo_bus`
+        self._bus_max : int = int(np.iinfo(int_dtype).max)
+        self._int_state : np.ndarray = np.empty(dim_topo + n_shunt, dtype=int_dtype)
+        np.clip(np.concatenate((init_topo_vect, init_shunt_bus)),
+                np.iinfo(int_dtype).min, self._bus_max,
+                out=self._int_state, casting="unsafe")
         if "detailed_topo_desc" in self._grid_obj_cls and self._grid_obj_cls["detailed_topo_desc"] is not None:
             self._switch_state = init_switch_state.copy()
         else:
             self._switch_state = None
+        self._has_switch_state : bool = self._switch_state is not None
+        
+        # arrays for which the "writeable" flag is changed by `prevent_modification`
+        self._writeable_targets : List[np.ndarray] = self._aux_get_writeable_targets()
+        
+        # attributes (that are not None) to compare in `where_different`
+        self._attrs_present : Tuple[str, ...] = type(self)._COMPARED_ATTRS
+        if self._has_switch_state:
+            self._attrs_present += ("_switch_state", )
         
+    @property
+    def _loads(self) -> np.ndarray:
+        # row 0: p, row 1: q
+        return self._float_state[self._loads_slice].reshape(2, -1)
+    
+    @property
+    def _gens(self) -> np.ndarray:
+        # row 0: p, row 1: v
+        return self._float_state[self._gens_slice].reshape(2, -1)
+    
+    @property
+    def _storage_p(self) -> np.ndarray:
+        return self._float_state[self._storage_slice]
+    
+    @property
+    def _shunts(self) -> np.ndarray:
+        # row 0: p, row 1: q
+        return self._float_state[self._shunts_slice].reshape(2, -1)
+    
+    @property
+    def _topo_vect(self) -> np.ndarray:
+        return self._int_state[self._topo_vect_slice]
+    
+    @property
+    def _shunt_bus(self) -> np.ndarray:
+        return self._int_state[self._shunt_bus_slice]
+    
+    @property
+    def _load_p(self) -> np.ndarray:
+        return self._loads[0]
+    
+    @property
+    def _load_q(self) -> np.ndarray:
+        return self._loads[1]
+    
+    @property
+    def _gen_p(self) -> np.ndarray:
+        return self._gens[0]
+    
+    @property
+    def _gen_v(self) -> np.ndarray:
+        return self._gens[1]
+    
+    @property
+    def _shunt_p(self) -> np.ndarray:
+        return self._shunts[0]
+    
+    @property
+    def _shunt_q(self) -> np.ndarray:
+        return self._shunts[1]
+    
     def __eq__(self, value: "_EnvPreviousState"):
-        return len(self.where_different(value)) == 0
+        return not self._any_different(value)
+    
+    def _any_different(self, oth: "_EnvPreviousState") -> bool:
+        """Same as `len(self.where_different(oth)) > 0` but stops at the first difference found"""
+        attrs_present = self._attrs_present
+        if attrs_present != getattr(oth, "_attrs_present", None):
+            # some attributes are missing or None in one of the objects
+            return len(self._aux_where_different_all(oth)) > 0
+        
+        if (self._layout == oth._layout and 
+                np.array_equal(self._float_state, oth._float_state) and
+                np.array_equal(self._int_state, oth._int_state)):
+            # everything (but the switches) is exactly equal, 
+            # this is the most common case
+            attrs_present = ("_switch_state", ) if self._has_switch_state else ()
+        
+        for attr_nm in attrs_present:
+            arr_me : np.ndarray = getattr(self, attr_nm)
+            arr_oth : np.ndarray = getattr(oth, attr_nm)
+            if arr_me.shape != arr_oth.shape:
+                return True
+            if not type(self)._aux_same_values(arr_me, arr_oth):
+                return True
+        return False
     
     def where_different(self, oth: "_EnvPreviousState") -> Dict[
         Literal["_load_p", "_load_q", "_gen_p", "_gen_v", "_storage_p", "_topo_vect", "_shunt_p", "_shunt_q", "_shunt_bus", "_switch_state"],
@@ -61,7 +254,26 @@ class _EnvPreviousState(object):
               Optional[np.ndarray], Optional[np.ndarray]]
     ]:
         """Where this object is different from another one"""
+        attrs_present = self._attrs_present
+        if attrs_present != getattr(oth, "_attrs_present", None):
+            # some attributes are missing or None in one of the objects
+            return self._aux_where_different_all(oth)
         
+        res = {}
+        for attr_nm in attrs_present:
+            arr_me : np.ndarray = getattr(self, attr_nm)
+            arr_oth : np.ndarray = getattr(oth, attr_nm)
+            if arr_me.shape != arr_oth.shape:
+                res[attr_nm] = ("size", arr_me.shape, arr_oth.shape)
+                continue
+            if type(self)._aux_same_values(arr_me, arr_oth):
+                # they match
+                continue
+            res[attr_nm] = ("values", arr_me.copy(), arr_oth.copy())
+        return res
+    
+    def _aux_where_different_all(self, oth: "_EnvPreviousState"):
+        """Same as `where_different` but handles also the case where attributes are missing or None"""
         res = {}
         for attr_nm in ["_load_p", "_load_q", "_gen_p", "_gen_v", "_storage_p", "_topo_vect", "_shunt_p", "_shunt_q", "_shunt_bus", "_switch_state"]:
             if not hasattr(self, attr_nm) and not hasattr(oth, attr_nm):
@@ -87,25 +299,39 @@ class _EnvPreviousState(object):
             if arr_me.shape != arr_oth.shape:
                 res[attr_nm] = ("size", arr_me.shape, arr_oth.shape)
                 continue
-            if np.allclose(arr_me, arr_oth):
+            if type(self)._aux_same_values(arr_me, arr_oth):
                 # they match
                 continue
             res[attr_nm] = ("values", arr_me.copy(), arr_oth.copy())
         return res
     
+    @staticmethod
+    def _aux_same_values(arr_me: np.ndarray, arr_oth: np.ndarray) -> bool:
+        """Same as `np.allclose(arr_me, arr_oth)` for arrays of the same shape, but
+        avoids the (costly) tolerance computation in the most common case where
+        values are exactly equal."""
+        if arr_me is arr_oth:
+            return True
+        if np.array_equal(arr_me, arr_oth):
+            return True
+        if arr_me.dtype.kind in "iub" and arr_oth.dtype.kind in "iub":
+            # no tolerance for integers / booleans
+            return False
+        return np.allclose(arr_me, arr_oth)
+    
     def copy(self):
-        return _EnvPreviousState(grid_obj_cls=self._grid_obj_cls,
-                                 init_load_p=self._load_p,
-                                 init_load_q=self._load_q,
-                                 init_gen_p=self._gen_p,
-                                 init_gen_v=self._gen_v,
-                                 init_topo_vect=self._topo_vect,
-                                 init_storage_p=self._storage_p,
-                                 init_shunt_p=self._shunt_p,
-                                 init_shunt_q=self._shunt_q,
-                                 init_shunt_bus = self._shunt_bus,
-                                 init_switch_state=self._switch_state,
-                                 )
+        res = object.__new__(type(self))
+        # data that only depend on the grid (eg `_load_pos_topo_vect`) are shared
+        # with the copy, this is also the case of the buffers used in `update` 
+        # which is fine as they are fully rewritten at each call
+        res.__dict__.update(self.__dict__)
+        res._can_modif = True
+        res._float_state = self._float_state.copy()
+        res._int_state = self._int_state.copy()
+        if self._has_switch_state:
+            res._switch_state = self._switch_state.copy()
+        res._writeable_targets = res._aux_get_writeable_targets()
+        return res
         
     def update(self,
                load_p : np.ndarray,
@@ -122,41 +348,54 @@ class _EnvPreviousState(object):
         if not self._can_modif:
             raise Grid2OpException(type(self).ERR_MSG_IMP_MODIF)
         
-        self._aux_update(topo_vect[self._grid_obj_cls["load_pos_topo_vect"]],
-                         self._load_p,
-                         load_p,
-                         self._load_q,
-                         load_q)
-        self._aux_update(topo_vect[self._grid_obj_cls["gen_pos_topo_vect"]],
-                         self._gen_p,
-                         gen_p,
-                         self._gen_v,
-                         gen_v)
-        self._topo_vect[topo_vect > 0] = 1 * topo_vect[topo_vect > 0]
-        
-        # update storage units
-        if self._n_storage > 0:
-            self._aux_update(topo_vect[self._grid_obj_cls["storage_pos_topo_vect"]],
-                            self._storage_p,
-                            storage_p)
+        if NUMBA_:
+            # loads, generators, storage units and topo_vect updated at once
+            _update_kernel(topo_vect,
+                           self._load_pos_topo_vect, load_p, load_q, self._loads,
+                           self._gen_pos_topo_vect, gen_p, gen_v, self._gens,
+                           self._storage_pos_topo_vect,
+                           storage_p if self._n_storage > 0 else self._storage_p,
+                           self._storage_p,
+                           self._topo_vect,
+                           self._bus_max)
+        else:
+            self._aux_update_numpy(load_p, load_q, gen_p, gen_v, topo_vect, storage_p)
         
         # handle shunts, if present
         if shunt_p is not None:
-            self._aux_update(shunt_bus,
-                             self._shunt_p,
-                             shunt_p,
-                             self._shunt_q,
-                             shunt_q)
-            self._shunt_bus[shunt_bus > 0] = 1 * shunt_bus[shunt_bus > 0]
+            self._aux_update(shunt_bus > 0, self._shunts, (shunt_p, shunt_q))
+            np.minimum(shunt_bus, self._bus_max, out=self._shunt_bus, where=shunt_bus > 0)
             
         if switches is not None:
-            if self._switch_state is None:
+            if not self._has_switch_state:
                 raise Grid2OpException("No known last switch state to update")
             self._switch_state[:] = switches
         else:
-            if self._switch_state is not None:
+            if self._has_switch_state:
                 raise Grid2OpException("No new switch values to update previous values")
                     
+    def _aux_update_numpy(self,
+                          load_p : np.ndarray,
+                          load_q : np.ndarray,
+                          gen_p : np.ndarray,
+                          gen_v : np.ndarray,
+                          topo_vect : np.ndarray,
+                          storage_p : Optional[np.ndarray]):
+        topo_vect = topo_vect.astype(dt_int, copy=False)  # needed for np.take(..., out=...), no copy most of the time
+        np.take(topo_vect, self._load_pos_topo_vect, out=self._load_bus_buffer)
+        np.greater(self._load_bus_buffer, 0, out=self._load_mask)
+        self._aux_update(self._load_mask, self._loads, (load_p, load_q))
+        np.take(topo_vect, self._gen_pos_topo_vect, out=self._gen_bus_buffer)
+        np.greater(self._gen_bus_buffer, 0, out=self._gen_mask)
+        self._aux_update(self._gen_mask, self._gens, (gen_p, gen_v))
+        np.minimum(topo_vect, self._bus_max, out=self._topo_vect, where=topo_vect > 0)
+        
+        # update storage units
+        if self._n_storage > 0:
+            np.take(topo_vect, self._storage_pos_topo_vect, out=self._storage_bus_buffer)
+            np.greater(self._storage_bus_buffer, 0, out=self._storage_mask)
+            self._aux_update(self._storage_mask, self._storage_p, storage_p)
+        
     def update_from_backend(self,
                             backend: "grid2op.Backend.Backend"):
         if not self._can_modif:
@@ -192,26 +431,16 @@ class _EnvPreviousState(object):
         if not self._can_modif:
             raise Grid2OpException(type(self).ERR_MSG_IMP_MODIF)
         
-        for attr_nm in ["_load_p",
-                        "_load_q",
-                        "_gen_p",
-                        "_gen_v",
-                        "_storage_p",
-                        "_topo_vect",
-                        "_shunt_p",
-                        "_shunt_q",
-                        "_shunt_bus"]:
-            tmp = getattr(self, attr_nm)
-            if tmp.size > 1:
-                # works only for array of size 2 or more
-                tmp[:] = copy.deepcopy(getattr(other, attr_nm))
-            else:
-                setattr(self, attr_nm, getattr(other, attr_nm))
+        np.copyto(self._float_state, other._float_state, casting="no")
+        np.copyto(self._int_state, other._int_state, casting="no")
         # if detailed topo
-        if hasattr(self, "_switch_state") and self._switch_state is not None:
+        if self._has_switch_state:
             self._switch_state[:] = other._switch_state
         
     def prevent_modification(self):
+        if not self._can_modif:
+            # already read only
+            return
         self._aux_modif()
         self._can_modif = False
         
@@ -224,35 +453,26 @@ class _EnvPreviousState(object):
         self.update_from_other(other)
         self.prevent_modification()
     
+    def _aux_get_writeable_targets(self) -> List[np.ndarray]:
+        # NB: `_float_state` and `_int_state` always have at least 2 elements
+        # (flags can't be set on arrays of size 1 apparently)
+        res = [self._float_state, self._int_state]
+        if self._has_switch_state:
+            res.append(self._switch_state)
+        return res
+    
     def _aux_modif(self, writeable_flag=False):
-        for attr_nm in ["_load_p",
-                        "_load_q",
-                        "_gen_p",
-                        "_gen_v",
-                        "_storage_p",
-                        "_topo_vect",
-                        "_shunt_p",
-                        "_shunt_q",
-                        "_shunt_bus"]:
-            tmp = getattr(self, attr_nm)
-            if tmp.size > 1:
-                # can't set flags on array of size 1 apparently
-                tmp.flags.writeable = writeable_flag
-                
-        # if detailed topo
-        if hasattr(self, "_switch_state") and self._switch_state is not None:
-            self._switch_state.flags.writeable = writeable_flag
+        # NB: `setflags` does not create the `flags` object of each array
+        for tmp in self._writeable_targets:
+            tmp.setflags(write=writeable_flag)
         
     def _aux_update(self,
-                    el_topo_vect : np.ndarray,
-                    arr1 : np.ndarray,
-                    arr1_new : np.ndarray,
-                    arr2 : Optional[np.ndarray] = None,
-                    arr2_new : Optional[np.ndarray] = None):
-        el_co = el_topo_vect > 0
-        arr1[el_co] = 1. * arr1_new[el_co]
-        if arr2 is not None:
-            arr2[el_co] = 1. * arr2_new[el_co]
+                    el_co : np.ndarray,
+                    arr : np.ndarray,
+                    arr_new : Union[np.ndarray, Tuple[np.ndarray, ...]]):
+        # if `arr` stores multiple rows (eg `_loads`), `arr_new` is the
+        # tuple of the new rows, all updated at once
+        np.copyto(arr, arr_new, where=el_co)
 
     
     def fix_topo_bus(self):
@@ -270,18 +490,28 @@ class _EnvPreviousState(object):
         be assigned to 0 which is not possible.
         
         """
-        if not ((self._topo_vect <= -2) |
-                (self._topo_vect == 0) | 
-                (self._topo_vect > int(self._grid_obj_cls["n_busbar_per_sub"]))
-               ).any():
+        topo_vect = self._topo_vect
+        if NUMBA_ and not self._has_switch_state:
+            if not _has_invalid_bus_kernel(topo_vect, self._n_busbar):
+                # all bus are ok
+                # nothing to do
+                return
+            if topo_vect.flags.writeable:
+                # fix everything at once
+                _fix_topo_bus_kernel(topo_vect, self._n_busbar)
+                return
+        
+        # masks are computed once and used both for the check and the fix
+        to_disco = (topo_vect <= -2) | (topo_vect == 0)
+        to_bus_1 = topo_vect > self._n_busbar
+        if not (to_disco.any() or to_bus_1.any()):
             # all bus are ok
             # nothing to do
             return
         
         # if detailed topo, not done ATM  # TODO
-        if hasattr(self, "_switch_state") and self._switch_state is not None:
+        if self._has_switch_state:
             raise RuntimeError("Disconnected element in the grid in the presence of switches. This is not handled at the moment.")
         
-        self._topo_vect[self._topo_vect <= -2] = -1
-        self._topo_vect[self._topo_vect == 0] = -1
-        self._topo_vect[self._topo_vect > int(self._grid_obj_cls["n_busbar_per_sub"])] = 1
+        topo_vect[to_disco] = -1
+        topo_vect[to_bus_1] = 1
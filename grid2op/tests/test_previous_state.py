@@ -8,13 +8,16 @@
 
 import copy
 import os
+import pickle
 from typing import Union
 import unittest
+from unittest.mock import patch
 import warnings
 
 import numpy as np
 import grid2op
 from grid2op.Action import BaseAction
+from grid2op.Exceptions import Grid2OpException
 import grid2op.Environment
 import grid2op.Environment._env_prev_state
 import grid2op.Observation
@@ -73,6 +76,14 @@ class PreviousStateTester(unittest.TestCase):
         obs, reward, done, info = self.env.step(self.env.action_space())
         self._aux_test_matches_obs(obs, self.env, "after 2nd step")
     
+    def test_regular_step_no_numba(self):
+        with patch.object(grid2op.Environment._env_prev_state, "NUMBA_", False):
+            self.test_regular_step()
+            
+    def test_storage_no_numba(self):
+        with patch.object(grid2op.Environment._env_prev_state, "NUMBA_", False):
+            self.test_storage()
+    
     def test_storage(self):
         sto_id = 0
         pos_tv = self.env.storage_pos_topo_vect[0]
@@ -435,8 +446,222 @@ class PreviousStateTester(unittest.TestCase):
     def test_shunt_for_env(self):
         # TODO
         pass
+
+    def test_where_different(self):
+        prev_state = self.env._previous_conn_state
+        prev_cpy = prev_state.copy()
+        assert prev_cpy == prev_state
+        assert len(prev_cpy.where_different(prev_state)) == 0
+
+        # small numerical noise is not a difference
+        prev_cpy._load_p[0] += 1e-9
+        assert prev_cpy == prev_state
+        assert len(prev_cpy.where_different(prev_state)) == 0
+
+        # but real differences are spotted
+        prev_cpy._load_p[0] += 1.
+        prev_cpy._topo_vect[0] = 2
+        res = prev_cpy.where_different(prev_state)
+        assert prev_cpy != prev_state
+        assert sorted(res.keys()) == ["_load_p", "_topo_vect"], f"{res.keys()}"
+        assert res["_load_p"][0] == "values"
+        assert res["_topo_vect"][0] == "values"
+
+    def test_fix_topo_bus_no_numba(self):
+        with patch.object(grid2op.Environment._env_prev_state, "NUMBA_", False):
+            self.test_fix_topo_bus()
+
+    def test_fix_topo_bus(self):
+        prev_cpy = self.env._previous_conn_state.copy()
+        prev_cpy._topo_vect[:] = 1
+        prev_cpy.fix_topo_bus()
+        assert (prev_cpy._topo_vect == 1).all()
+
+        n_busbar = type(self.env).n_busbar_per_sub
+        prev_cpy._topo_vect[:5] = [-3, -1, 0, n_busbar, n_busbar + 1]
+        prev_cpy.fix_topo_bus()
+        assert (prev_cpy._topo_vect[:5] == [-1, -1, -1, n_busbar, 1]).all(), f"{prev_cpy._topo_vect[:5]}"
+        assert (prev_cpy._topo_vect[5:] == 1).all()
+
+        # nothing to fix: works on read only objects
+        prev_cpy.prevent_modification()
+        prev_cpy.fix_topo_bus()
+        assert (prev_cpy._topo_vect[:5] == [-1, -1, -1, n_busbar, 1]).all(), f"{prev_cpy._topo_vect[:5]}"
+        
+        # something to fix: read only objects cannot be modified
+        prev_cst = self.env._previous_conn_state.copy()
+        prev_cst._topo_vect[0] = 0
+        prev_cst.prevent_modification()
+        with self.assertRaises(ValueError):
+            prev_cst.fix_topo_bus()
+
+    def test_prevent_modification(self):
+        prev_state = self.env._previous_conn_state
+        prev_cpy = prev_state.copy()
+        prev_cpy.prevent_modification()
+        assert not prev_cpy._can_modif
+        with self.assertRaises(ValueError):
+            prev_cpy._load_p[0] = 1.
+        with self.assertRaises(ValueError):
+            prev_cpy._topo_vect[0] = 2
+        with self.assertRaises(Grid2OpException):
+            prev_cpy.update_from_other(prev_state)
+
+        # force_update still works and the object stays read only
+        prev_other = prev_state.copy()
+        prev_other._load_p[0] += 1.
+        prev_cpy.force_update(prev_other)
+        assert not prev_cpy._can_modif
+        assert prev_cpy == prev_other
+        with self.assertRaises(ValueError):
+            prev_cpy._load_p[0] = 1.
+
+    def test_copy_read_only(self):
+        prev_state = self.env._previous_conn_state
+        cst_state = prev_state.copy()
+        cst_state.prevent_modification()
+
+        # copy of a read only object can be modified
+        prev_cpy = cst_state.copy()
+        assert prev_cpy._can_modif
+        assert prev_cpy == cst_state
+        assert not np.shares_memory(prev_cpy._load_p, cst_state._load_p)
+        prev_cpy._topo_vect[0] = 2
+        prev_cpy._load_p[0] += 1.
+        assert cst_state == prev_state
+        prev_cpy.update_from_other(prev_state)
+        assert prev_cpy == prev_state
+
+        # modifying the original object does not modify its copy
+        prev_other = prev_state.copy()
+        prev_other._load_p[0] += 1.
+        cst_state.force_update(prev_other)
+        assert cst_state == prev_other
+        assert prev_cpy == prev_state
+        assert not cst_state._can_modif
+        with self.assertRaises(ValueError):
+            cst_state._load_p[0] = 1.
+
+
+    def test_copy_shares_static_data(self):
+        prev_state = self.env._previous_conn_state
+        prev_cpy = prev_state.copy()
+        assert prev_cpy._grid_obj_cls is prev_state._grid_obj_cls
+        assert prev_cpy._load_pos_topo_vect is prev_state._load_pos_topo_vect
+        assert prev_cpy._gen_pos_topo_vect is prev_state._gen_pos_topo_vect
+        assert prev_cpy._storage_pos_topo_vect is prev_state._storage_pos_topo_vect
+        # but not the values
+        assert not np.shares_memory(prev_cpy._float_state, prev_state._float_state)
+        assert not np.shares_memory(prev_cpy._int_state, prev_state._int_state)
+        prev_cpy._load_p[0] += 1.
+        prev_cpy._topo_vect[0] = 2
+        assert prev_cpy != prev_state
+
+
+    def test_views_modify_state(self):
+        prev_cpy = self.env._previous_conn_state.copy()
+        prev_cpy._load_p[0] = 1.
+        prev_cpy._load_q[0] = 2.
+        prev_cpy._gen_v[0] = 3.
+        prev_cpy._storage_p[0] = 4.
+        prev_cpy._topo_vect[0] = 2
+        assert prev_cpy._float_state[0] == 1.
+        assert prev_cpy._loads[1, 0] == 2.
+        assert prev_cpy._gens[1, 0] == 3.
+        assert prev_cpy._float_state[2 * (self.env.n_load + self.env.n_gen)] == 4.
+        assert prev_cpy._int_state[0] == 2
+        assert prev_cpy._load_p[0] == 1.
+        assert prev_cpy._topo_vect[0] == 2
+        
+    def test_pickle_deepcopy(self):
+        prev_cpy = self.env._previous_conn_state.copy()
+        prev_cpy._load_p[0] += 1.
+        prev_cpy._topo_vect[0] = 2
+        for prev_res in [copy.deepcopy(prev_cpy), pickle.loads(pickle.dumps(prev_cpy))]:
+            assert prev_res == prev_cpy
+            assert prev_res._float_state.dtype == prev_cpy._float_state.dtype
+            assert prev_res._int_state.dtype == prev_cpy._int_state.dtype
+            # views are still views on the stored values
+            prev_res._load_p[0] += 1.
+            prev_res._topo_vect[0] = 1
+            assert prev_res._float_state[0] == prev_cpy._load_p[0] + 1.
+            assert prev_res._int_state[0] == 1
+            assert prev_cpy._topo_vect[0] == 2
+        
+    def test_float_dtype(self):
+        env_cls = type(self.env)
+        prev_state = self.env._previous_conn_state
+        n_shunt = prev_state._shunt_p.shape[0]
+        # shunt values in float64, the rest in float32: nothing is truncated
+        shunt_p = np.full(n_shunt, 1. + 1e-12, dtype=np.float64)
+        prev_state = grid2op.Environment._env_prev_state._EnvPreviousState(
+            env_cls,
+            prev_state._load_p.astype(np.float32),
+            prev_state._load_q.astype(np.float32),
+            prev_state._gen_p.astype(np.float32),
+            prev_state._gen_v.astype(np.float32),
+            prev_state._topo_vect,
+            prev_state._storage_p.astype(np.float32),
+            shunt_p,
+            np.zeros(n_shunt, dtype=np.float64),
+            prev_state._shunt_bus)
+        assert prev_state._float_state.dtype == np.float64
+        assert (prev_state._shunt_p == shunt_p).all()
+
+
+    def test_int_dtype(self):
+        prev_state = self.env._previous_conn_state
+        assert prev_state._topo_vect.dtype == np.int8
+        assert prev_state._shunt_bus.dtype == np.int8
+        
+        # too much busbars for int8
+        cls_dict = dict(prev_state._grid_obj_cls)
+        cls_dict["n_busbar_per_sub"] = 200
+        topo_vect = prev_state._topo_vect.astype(np.int32)
+        topo_vect[0] = 200
+        prev_big = grid2op.Environment._env_prev_state._EnvPreviousState(
+            cls_dict,
+            prev_state._load_p,
+            prev_state._load_q,
+            prev_state._gen_p,
+            prev_state._gen_v,
+            topo_vect,
+            prev_state._storage_p,
+            prev_state._shunt_p,
+            prev_state._shunt_q,
+            prev_state._shunt_bus.astype(np.int32))
+        assert prev_big._topo_vect.dtype == np.int32
+        assert prev_big._shunt_bus.dtype == np.int32
+        assert prev_big._topo_vect[0] == 200
+        prev_big.fix_topo_bus()
+        assert prev_big._topo_vect[0] == 200
+        prev_cpy = prev_big.copy()
+        assert prev_cpy._topo_vect.dtype == np.int32
+        assert prev_cpy == prev_big
     
-    
+    def test_int8_out_of_range_bus_no_numba(self):
+        with patch.object(grid2op.Environment._env_prev_state, "NUMBA_", False):
+            self.test_int8_out_of_range_bus()
+            
+    def test_int8_out_of_range_bus(self):
+        # buses that do not fit in int8 are not wrapped around
+        prev_cpy = self.env._previous_conn_state.copy()
+        topo_vect = np.ones(self.env.dim_topo, dtype=np.int32)
+        topo_vect[0] = 128
+        topo_vect[1] = 300
+        shunt_bus = np.full(self.env.n_shunt, 256, dtype=np.int32)
+        prev_cpy.update(prev_cpy._load_p, prev_cpy._load_q,
+                        prev_cpy._gen_p, prev_cpy._gen_v,
+                        topo_vect,
+                        prev_cpy._storage_p,
+                        prev_cpy._shunt_p, prev_cpy._shunt_q, shunt_bus,
+                        None)
+        assert (prev_cpy._topo_vect[:2] == 127).all(), f"{prev_cpy._topo_vect[:2]}"
+        assert (prev_cpy._shunt_bus == 127).all(), f"{prev_cpy._shunt_bus}"
+        prev_cpy.fix_topo_bus()
+        assert (prev_cpy._topo_vect == 1).all(), f"{prev_cpy._topo_vect}"
+
+
 class TestWithGridLineDisco(unittest.TestCase):
     def setUp(self):
         with warnings.catch_warnings():